@@ -6,10 +6,17 @@
 #   Cedric Nugteren <www.cedricnugteren.nl>
 
 import os
+import sys
+import itertools
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from operator import itemgetter
 
 # Type settings (also change in database_structure.hpp)
 STRING_LENGTH = 50
 PARAMETERS_LENGTH = 16
+ZERO_PARAMETERS = ("0",) * PARAMETERS_LENGTH
 
 # Constants from the C++ code
 VENDOR_DEFAULT = "default"
@@ -18,6 +25,12 @@ DEVICE_NAME_DEFAULT = "default"
 DEVICE_NAME_DEFAULT_CONSTANT = "kDeviceNameDefault                                        "
 DEVICE_ARCHITECTURE_DEFAULT = "default"
 
+# Format strings for the C++ code
+CPP_DEVICE_VENDOR_DEFAULT = "    {{ // Default\n      kDeviceType{device_type}, \"{vendor}\", {{\n"
+CPP_DEVICE_VENDOR = "    {{ // {vendor} {device_type}s\n      kDeviceType{device_type_caps}, \"{vendor}\", {{\n"
+CPP_ARCHITECTURE = "        {{ \"{}\", {{\n"
+CPP_DEVICE = "          {{ {}, Params{{ "
+
 # List of attributes
 DEVICE_TYPE_ATTRIBUTES = ["clblast_device_vendor", "clblast_device_type"]
 DEVICE_ATTRIBUTES = ["clblast_device_name", "clblast_device_architecture",
@@ -27,33 +40,37 @@ ARGUMENT_ATTRIBUTES = ["arg_m", "arg_n", "arg_k", "arg_alpha", "arg_beta",
                        "arg_from", "arg_to", "arg_step",
                        "arg_channels", "arg_height", "arg_width", "arg_kernel_h", "arg_kernel_w",
                        "arg_num_kernels", "arg_batch_count"]
+CPP_DATABASE_ATTRIBUTES = ["kernel_family", "precision", "clblast_device_vendor", "clblast_device_type",
+                           "clblast_device_architecture", "clblast_device_name", "kernel"]
 ATTRIBUTES = DEVICE_ATTRIBUTES + DEVICE_TYPE_ATTRIBUTES + KERNEL_ATTRIBUTES + ARGUMENT_ATTRIBUTES
 GROUP_ATTRIBUTES = DEVICE_TYPE_ATTRIBUTES + KERNEL_ATTRIBUTES + ["kernel"] + ARGUMENT_ATTRIBUTES
 
 # Other constants
 VENDORS_WITH_ARCHITECTURE = ["AMD", "NVIDIA"]
+WINDOWS_MAX_WORKERS = 61  # Upper limit of ProcessPoolExecutor on Windows
+PRECISION_NAMES = {"16": "Half", "32": "Single", "64": "Double", "3232": "ComplexSingle", "6464": "ComplexDouble"}
 
 def precision_to_string(precision):
     """Translates a precision number (represented as Python string) into a descriptive string"""
-    if precision == "16":
-        return "Half"
-    elif precision == "32":
-        return "Single"
-    elif precision == "64":
-        return "Double"
-    elif precision == "3232":
-        return "ComplexSingle"
-    elif precision == "6464":
-        return "ComplexDouble"
-    else:
-        raise("Unknown precision: " + precision)
+    try:
+        return PRECISION_NAMES[precision]
+    except KeyError:
+        raise ValueError("Unknown precision: " + precision)
+
+
+@lru_cache(maxsize=None)
+def get_camelcase_name(family):
+    """Translates a kernel family name (e.g. 'gemm_routine') into its camel-cased C++ name (e.g. 'GemmRoutine')"""
+    return family.title().replace("_", "")
 
 
+@lru_cache(maxsize=None)
 def get_cpp_separator():
     """Retrieves a C++ comment separator"""
     return "// ================================================================================================="
 
 
+@lru_cache(maxsize=None)
 def get_cpp_header(family, precision):
     """Retrieves the C++ header"""
     return ("\n" + get_cpp_separator() + """
@@ -65,77 +82,95 @@ def get_cpp_header(family, precision):
             % (family.title(), precision)) + get_cpp_separator() + "\n"
 
 
+@lru_cache(maxsize=None)
 def get_cpp_header_namespace():
     return "\nnamespace clblast {\n" + "namespace database {\n"
 
 
+@lru_cache(maxsize=None)
 def get_cpp_footer():
     """Retrieves the C++ footer"""
     return "\n} // namespace database\n" + "} // namespace clblast\n"
 
 
+@lru_cache(maxsize=None)
 def get_cpp_precision(family, precision):
     """Retrieves the C++ code for the start of a new precision"""
     precision_string = precision_to_string(precision)
-    camelcase_name = family.title().replace("_", "")
+    camelcase_name = get_camelcase_name(family)
     return("\nconst DatabaseEntry %s%s = {\n  \"%s\", Precision::k%s"
            % (camelcase_name, precision_string, camelcase_name, precision_string))
 
 
+@lru_cache(maxsize=None)
 def get_cpp_device_vendor(vendor, device_type):
     """Retrieves the C++ code for the (default) vendor and device type"""
     if vendor == VENDOR_DEFAULT and device_type == DEVICE_TYPE_DEFAULT:
-        return "    { // Default\n      kDeviceType%s, \"%s\", {\n" % (device_type, vendor)
+        return CPP_DEVICE_VENDOR_DEFAULT.format(vendor=vendor, device_type=device_type)
     device_type_caps = device_type[0].upper() + device_type[1:]
-    return "    { // %s %ss\n      kDeviceType%s, \"%s\", {\n" % (vendor, device_type, device_type_caps, vendor)
+    return CPP_DEVICE_VENDOR.format(vendor=vendor, device_type=device_type, device_type_caps=device_type_caps)
 
 
+@lru_cache(maxsize=None)
 def get_cpp_family_includes(family, precisions):
-    result = "\n"
-    result += "#include \"database/kernels/%s/%s.hpp\"\n" % (family, family)
-    for precision in precisions:
-        result += "#include \"database/kernels/%s/%s_%s.hpp\"\n" % (family, family, precision)
-    return result
+    """Retrieves the C++ includes of all precisions of a kernel family"""
+    includes = ["#include \"database/kernels/%s/%s.hpp\"\n" % (family, family)]
+    includes.extend("#include \"database/kernels/%s/%s_%s.hpp\"\n" % (family, family, precision)
+                    for precision in precisions)
+    return "\n" + "".join(includes)
 
 
+@lru_cache(maxsize=None)
 def get_hpp_family_includes(family, precisions):
-    result = "\n"
-    result += "#include \"database/database_structure.hpp\"\n"
-    result += "\n"
-    result += "namespace clblast {\n"
-    result += "namespace database {\n"
-    result += "\n"
-    camelcase_name = family.title().replace("_", "")
-    for precision in precisions:
-        precision_string = precision_to_string(precision)
-        result += "extern const DatabaseEntry %s%s;\n" % (camelcase_name, precision_string)
-    result += "\n"
-    result += "} // namespace database\n"
-    result += "} // namespace clblast\n"
-    return result
+    """Retrieves the C++ header declaring the database entries of all precisions of a kernel family"""
+    camelcase_name = get_camelcase_name(family)
+    declarations = "".join("extern const DatabaseEntry %s%s;\n" % (camelcase_name, precision_to_string(precision))
+                           for precision in precisions)
+    return ("\n#include \"database/database_structure.hpp\"\n" +
+            "\nnamespace clblast {\nnamespace database {\n\n" +
+            declarations +
+            "\n} // namespace database\n} // namespace clblast\n")
 
 
+@lru_cache(maxsize=4096)
 def print_as_name(name):
-    return "Name{\"%-50s\"}" % name.strip()[:STRING_LENGTH]
+    """Retrieves the C++ code for a device name, padded to a fixed width"""
+    trimmed_name = name.strip()[:STRING_LENGTH]
+    return f'Name{{"{trimmed_name:<50s}"}}'
+
+
+def get_parameters_getter(parameter_order):
+    """Retrieves a function returning the values of the given parameters as a tuple, in the given order"""
+    if len(parameter_order) == 0:
+        return lambda parameters: ()
+    if len(parameter_order) == 1:
+        parameter_name = parameter_order[0]
+        return lambda parameters: (parameters[parameter_name],)
+    return itemgetter(*parameter_order)
 
 
 def get_kernel_database_results(kernel_database):
     """Retrieves the best result from a group of results. Asserts for valid data"""
     assert len(kernel_database) >= 1
 
+    # Fast path for the common case of a single valid item: there is nothing to compare
+    if len(kernel_database) == 1 and len(kernel_database[0]["results"]) == 1:
+        return kernel_database[0]["results"]
+
     all_results = [item["results"] for item in kernel_database]
 
     best_results = all_results[0]
+    best_parameter_names = sorted(best_results[0]["parameters"])  # Asserted below to be equal for all results
     for results in all_results:
 
         # Debugging in case of unexpected results
         length_assumption = (len(results) == 1)
-        params_assumption = (sorted(results[0]["parameters"]) == sorted(best_results[0]["parameters"]))
+        params_assumption = (sorted(results[0]["parameters"]) == best_parameter_names)
         if not length_assumption or not params_assumption:
             print("[database] ERROR: Found %d kernel databases, expected 1" % len(kernel_database))
-            all_keys = sorted([key for item in kernel_database for key in item.keys()])
-            missing_keys = set([x for x in all_keys if all_keys.count(x) != len(kernel_database)])
-            print("[database] All keys in databases: %s" % str(set(all_keys)))
+            key_counts = Counter(key for item in kernel_database for key in item.keys())
+            missing_keys = set([key for key, count in key_counts.items() if count != len(kernel_database)])
+            print("[database] All keys in databases: %s" % str(set(key_counts)))
             print("[database] Missing keys in one or more databases: %s" % str(missing_keys))
             for index, item in enumerate(kernel_database):
                 print("[database] %d:" % index)
@@ -149,121 +184,149 @@ def get_kernel_database_results(kernel_database):
     return best_results
 
 
+def write_cpp_file(filename, contents):
+    """Writes a generated C++ file with a single system call on a raw file descriptor, bypassing Python's buffered
+    text IO. Line endings are written as-is on all platforms"""
+    data = contents.encode("utf-8")
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        while len(data) > 0:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
+
+def get_cpp_device_parameters(device_database, parameter_names, parameter_orders, parameter_getters):
+    """Retrieves the C++ code for the tuning parameters of a single device, based on the best results per kernel.
+    The sections in the device database have to be sorted by kernel name"""
+    parameters = []
+    parameter_index = 0
+    for kernel, kernel_group in itertools.groupby(device_database, key=itemgetter("kernel")):
+        results = get_kernel_database_results(list(kernel_group))
+
+        assert len(results) == 1
+        new_parameters = results[0]["parameters"]
+        parameter_order = parameter_orders[kernel]
+        next_parameter_index = parameter_index + len(parameter_order)
+        assert new_parameters.keys() == set(parameter_order)
+        assert parameter_order == parameter_names[parameter_index:next_parameter_index]
+        parameters.extend(map(str, parameter_getters[kernel](new_parameters)))
+        parameter_index = next_parameter_index
+
+    # Appends zero's to complete the list
+    assert parameter_index <= PARAMETERS_LENGTH
+    return ", ".join(itertools.chain(parameters, ZERO_PARAMETERS[parameter_index:])) + " } },\n"
+
+
+def print_cpp_family(family_name, precision_databases, precisions, output_dir):
+    """Outputs the C++ code for a single kernel family, given its database sections per precision"""
+
+    # Goes into a new path for each kernel family
+    family_path = os.path.join(output_dir, family_name)
+
+    # Loops over the different precision (e.g. 16, 32, 3232, 64, 6464)
+    for precision in precisions:
+        precision_database = precision_databases.get(precision, [])
+
+        # Collects the contents of a new file for each precision
+        parts = []
+        parts.append(get_cpp_header(family_name, precision))
+        parts.append(get_cpp_header_namespace())
+        parts.append(get_cpp_precision(family_name, precision))
+
+        # In case there is nothing found at all (e.g. 16-bit): continue as if this was a
+        #  precision of 32 but with the defaults only
+        if len(precision_database) == 0:
+            print("[database] No results found for %s:%s, retrieving defaults from %s:32" %
+                  (family_name, precision, family_name))
+            precision_database = [s for s in precision_databases.get("32", [])
+                                  if s["clblast_device_vendor"] == VENDOR_DEFAULT
+                                  and s["clblast_device_type"] == DEVICE_TYPE_DEFAULT
+                                  and s["clblast_device_name"] == DEVICE_NAME_DEFAULT]
+
+        # Discovers the parameters for this kernel, as well as their (sorted) order per kernel
+        parameter_names = set()
+        parameter_orders = {}
+        for example_data in precision_database:
+            for example_result in example_data["results"]:
+                parameter_names.update(example_result["parameters"])
+                if example_data["kernel"] not in parameter_orders:
+                    parameter_orders[example_data["kernel"]] = tuple(sorted(example_result["parameters"]))
+        parameter_names = tuple(sorted(parameter_names))
+        parameter_getters = {kernel: get_parameters_getter(parameter_order)
+                             for kernel, parameter_order in parameter_orders.items()}
+        parameter_names_as_string = ", ".join(['"%s"' % p for p in parameter_names])
+        parts.append(", {" + parameter_names_as_string + "}, {\n")
+
+        # Loops over the combinations of device vendors and types (e.g. AMD GPU)
+        for (vendor, device_type), type_group in itertools.groupby(precision_database,
+                                                                   key=itemgetter(*DEVICE_TYPE_ATTRIBUTES)):
+            parts.append(get_cpp_device_vendor(vendor, device_type))
+
+            # Loops over every architecture of this vendor-type combination
+            for architecture, architecture_group in itertools.groupby(
+                    type_group, key=itemgetter("clblast_device_architecture")):
+                if vendor in VENDORS_WITH_ARCHITECTURE and architecture == "":
+                    continue
+                architecture_string = DEVICE_ARCHITECTURE_DEFAULT if architecture == "" else architecture
+                parts.append(CPP_ARCHITECTURE.format(architecture_string))
+
+                # Loops over every device of this vendor-type combination
+                for device_name, device_group in itertools.groupby(
+                        architecture_group, key=itemgetter("clblast_device_name")):
+                    device_name_as_string = print_as_name(device_name) if device_name != DEVICE_NAME_DEFAULT else DEVICE_NAME_DEFAULT_CONSTANT
+                    parts.append(CPP_DEVICE.format(device_name_as_string))
+                    parts.append(get_cpp_device_parameters(device_group, parameter_names, parameter_orders,
+                                                           parameter_getters))
+
+                # Prints the architecture footer
+                parts.append("        } },\n")
+
+            # Prints the vendor-type combination footer
+            parts.append("      }\n    },\n")
+
+        # Prints the precision footer
+        parts.append("  }\n};\n")
+
+        # Prints the file footer
+        parts.append(get_cpp_footer())
+
+        # Writes the file in one go
+        full_path = os.path.join(family_path, family_name + "_" + precision + ".hpp")
+        write_cpp_file(full_path, "".join(parts))
+
+        # Creates the combined family sources
+        full_path = os.path.join(family_path, family_name + ".cpp")
+        write_cpp_file(full_path, get_cpp_header(family_name, "") +
+                       get_cpp_family_includes(family_name, precisions))
+
+        # Creates the combined family includes header
+        full_path = os.path.join(family_path, family_name + ".hpp")
+        write_cpp_file(full_path, get_cpp_header(family_name, "") +
+                       get_hpp_family_includes(family_name, precisions))
+
+
 def print_cpp_database(database, output_dir):
     """Outputs the database as C++ code"""
 
-    # Iterates over the kernel families
-    kernel_families = sorted(set([s["kernel_family"] for s in database["sections"]]))
-    for family_name in kernel_families:
-        family_database = [s for s in database["sections"] if s["kernel_family"] == family_name]
-
-        # Goes into a new path for each kernel family
-        family_path = os.path.join(output_dir, family_name)
-
-        # Loops over the different precision (e.g. 16, 32, 3232, 64, 6464)
-        precisions = sorted(set([s["precision"] for s in database["sections"]]))  # Based on full database
-        for precision in precisions:
-            precision_database = [s for s in family_database if s["precision"] == precision]
-
-            # Opens a new file for each precision
-            full_path = os.path.join(family_path, family_name + "_" + precision + ".hpp")
-            with open(full_path, 'w+') as f:
-                f.write(get_cpp_header(family_name, precision))
-                f.write(get_cpp_header_namespace())
-                f.write(get_cpp_precision(family_name, precision))
-
-                # In case there is nothing found at all (e.g. 16-bit): continue as if this was a
-                #  precision of 32 but with the defaults only
-                if len(precision_database) == 0:
-                    print("[database] No results found for %s:%s, retrieving defaults from %s:32" %
-                          (family_name, precision, family_name))
-                    precision_database = [s for s in family_database if s["precision"] == "32"
-                                          and s["clblast_device_vendor"] == VENDOR_DEFAULT
-                                          and s["clblast_device_type"] == DEVICE_TYPE_DEFAULT
-                                          and s["clblast_device_name"] == DEVICE_NAME_DEFAULT]
-
-                # Discovers the parameters for this kernel
-                parameter_names = []
-                for example_data in precision_database:
-                    for example_result in example_data["results"]:
-                        parameter_names.extend([str(k) for k in example_result["parameters"].keys()])
-                parameter_names = sorted(list(set(parameter_names)))
-                parameter_names_as_string = ", ".join(['"%s"' % p for p in parameter_names])
-                f.write(", {" + parameter_names_as_string + "}, {\n")
-
-                # Loops over device vendors (e.g. AMD)
-                device_vendors = sorted(set([s["clblast_device_vendor"] for s in precision_database]))
-                for vendor in device_vendors:
-                    vendor_database = [s for s in precision_database if s["clblast_device_vendor"] == vendor]
-
-                    # Loops over device types (e.g. GPU)
-                    device_types = sorted(set([s["clblast_device_type"] for s in vendor_database]))
-                    for device_type in device_types:
-                        type_database = [s for s in vendor_database if s["clblast_device_type"] == device_type]
-                        f.write(get_cpp_device_vendor(vendor, device_type))
-
-                        # Loops over every architecture of this vendor-type combination
-                        architectures = sorted(set([s["clblast_device_architecture"] for s in type_database]))
-                        if vendor in VENDORS_WITH_ARCHITECTURE:
-                            architectures = [a for a in architectures if a != ""]
-                        for architecture in architectures:
-                            architecture_database = [s for s in type_database if s["clblast_device_architecture"] == architecture]
-                            architecture_string = DEVICE_ARCHITECTURE_DEFAULT if architecture == "" else architecture
-                            f.write("        { \"%s\", {\n" % architecture_string)
-
-                            # Loops over every device of this vendor-type combination
-                            devices = sorted(set([s["clblast_device_name"] for s in architecture_database]))
-                            for device_name in devices:
-                                device_database = [s for s in architecture_database if s["clblast_device_name"] == device_name]
-                                device_name_as_string = print_as_name(device_name) if device_name != DEVICE_NAME_DEFAULT else DEVICE_NAME_DEFAULT_CONSTANT
-                                device_name_cpp = "          { %s, Params{ " % device_name_as_string
-                                f.write(device_name_cpp)
-
-                                # Collects the parameters for this entry
-                                parameters = []
-                                parameter_index = 0
-                                kernels = sorted(set([s["kernel"] for s in device_database]))
-                                for kernel in kernels:
-                                    kernel_database = [s for s in device_database if s["kernel"] == kernel]
-                                    results = get_kernel_database_results(kernel_database)
-
-                                    assert len(results) == 1
-                                    new_parameters = results[0]["parameters"]
-                                    for parameter_name in sorted(new_parameters):
-                                        assert parameter_name == parameter_names[parameter_index]
-                                        parameter_value = new_parameters[parameter_name]
-                                        parameters.append(str(parameter_value))
-                                        parameter_index += 1
-
-                                # Appends zero's to complete the list
-                                assert parameter_index <= PARAMETERS_LENGTH
-                                for append_index in range(parameter_index, PARAMETERS_LENGTH):
-                                    parameters.append("0")
-
-                                # Prints the entry
-                                f.write(", ".join(parameters))
-                                f.write(" } },\n")
-
-                            # Prints the architecture footer
-                            f.write("        } },\n")
-
-                        # Prints the vendor-type combination footer
-                        f.write("      }\n    },\n")
-
-                # Prints the precision footer
-                f.write("  }\n};\n")
-
-                # Prints the file footer
-                f.write(get_cpp_footer())
-
-            # Creates the combined family sources
-            full_path = os.path.join(family_path, family_name + ".cpp")
-            with open(full_path, 'w+') as f:
-                f.write(get_cpp_header(family_name, ""))
-                f.write(get_cpp_family_includes(family_name, precisions))
-
-            # Creates the combined family includes header
-            full_path = os.path.join(family_path, family_name + ".hpp")
-            with open(full_path, 'w+') as f:
-                f.write(get_cpp_header(family_name, ""))
-                f.write(get_hpp_family_includes(family_name, precisions))
+    # Sorts the sections once such that every level below can be walked as a group
+    sections = sorted(database["sections"], key=itemgetter(*CPP_DATABASE_ATTRIBUTES))
+
+    # Buckets the sections per kernel family and precision in a single pass, also collecting the set of precisions
+    family_databases = {}
+    precisions = set()
+    for (family_name, precision), group in itertools.groupby(sections, key=itemgetter("kernel_family", "precision")):
+        family_databases.setdefault(family_name, {})[precision] = list(group)
+        precisions.add(precision)
+    precisions = tuple(sorted(precisions))  # Based on full database
+
+    # Outputs the kernel families in parallel: they are written to independent files. The results are consumed to
+    # propagate any errors raised in the worker processes.
+    family_names = sorted(family_databases.keys())
+    max_workers = max(1, min(len(family_names), os.cpu_count() or 1))
+    if sys.platform == "win32":
+        max_workers = min(max_workers, WINDOWS_MAX_WORKERS)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(print_cpp_family, family_names,
+                          [family_databases[family_name] for family_name in family_names],
+                          itertools.repeat(precisions), itertools.repeat(output_dir), chunksize=1))